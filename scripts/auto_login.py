@@ -10,30 +10,85 @@ import os
 import sys
 import time
 import base64
+import binascii
+import json
 import re
+import tempfile
+import threading
 import requests
-from playwright.sync_api import sync_playwright
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 
 # ==================== 配置 ====================
 CLAW_CLOUD_URL = "https://ap-northeast-1.run.claw.cloud"
 SIGNIN_URL = f"{CLAW_CLOUD_URL}/signin"
+PUBKEY_TTL = 600  # 仓库公钥缓存 10 分钟
 DEVICE_VERIFY_WAIT = 30  # Mobile验证 默认等 30 秒
 TWO_FACTOR_WAIT = int(os.environ.get("TWO_FACTOR_WAIT", "120"))  # 2FA验证 默认等 120 秒
+# 只看 URL 和表单，不需要图片/字体/媒体和统计脚本；用正则交给浏览器端匹配，其它请求不经过 Python
+BLOCK_RE = re.compile(
+    r'\.(png|jpe?g|gif|webp|avif|svg|ico|woff2?|ttf|otf|eot|mp4|webm|mp3)(\?|#|$)'
+    r'|google-analytics|googletagmanager|doubleclick',
+    re.I
+)
+FORM_CLIP = {'x': 240, 'y': 0, 'width': 800, 'height': 600}  # 登录/验证表单区域（视口居中）
+STATE_FILE = "gh_state.json"  # Playwright storage_state（Cookie + localStorage）
+
+# URL 判断（预编译，wait_for_url 谓词里直接用，不再每次 lower()）
+# 已回到 ClawCloud 且不在登录页：只看域名和路径，不会被 GitHub 授权页里的 redirect_uri 误匹配
+_FINAL_RE = re.compile(r'^https?://[^/?#]*claw\.cloud(?=[/?#:]|$)(?![^?#]*signin)', re.I)
+_OAUTH_RE = re.compile(r'github\.com/login/oauth/authorize')
+_DEVICE_RE = re.compile(r'verified-device|device-verification')
+_TWO_FACTOR_RE = re.compile(r'github\.com/sessions/two-factor/')
+_TWO_FACTOR_MOBILE_RE = re.compile(r'github\.com/sessions/two-factor/mobile')
+_LOGIN_RE = re.compile(r'github\.com/login(?!/oauth)')  # GitHub 登录页（不含 OAuth 授权页）
+_GH_AUTH_RE = re.compile(r'github\.com/(login(?!/oauth)|session)')  # 需要走登录流程的页面
+
+
+def new_session():
+    """带连接池和 429/5xx 重试的 HTTP 会话"""
+    http = requests.Session()
+    http.headers['User-Agent'] = 'clawcloud-autologin'
+    http.mount("https://", HTTPAdapter(
+        pool_connections=2, pool_maxsize=2,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    ))
+    # Telegram：sendMessage/sendPhoto 等 POST 才会撞上限流，429 表示请求没被处理，可以安全重发（按 Retry-After 等待）
+    # 5xx 和读超时不重发，避免重复消息
+    http.mount("https://api.telegram.org/", HTTPAdapter(
+        pool_connections=1, pool_maxsize=2,
+        max_retries=Retry(total=3, read=0, backoff_factor=0.5, status_forcelist=[429], allowed_methods=None)
+    ))
+    return http
+
+
+# 全局共用一个 HTTP 会话（Telegram + GitHub API），复用连接，避免每次请求都重新 TCP + TLS 握手
+# requests.Session 不保证线程安全，后台线程要用自己的会话
+HTTP = new_session()
+
+
+def block_assets(route):
+    """拦截图片/字体/媒体和统计脚本（只会收到匹配 BLOCK_RE 的请求），减少下载量和页面渲染"""
+    route.abort()
 
 
 class Telegram:
     """Telegram 通知"""
     
+    _CODE_RE = re.compile(r"^/code\s+(\d{6,8})$")  # 6位TOTP 或 8位恢复码也行
+    
     def __init__(self):
         self.token = os.environ.get('TG_BOT_TOKEN')
         self.chat_id = os.environ.get('TG_CHAT_ID')
+        self._chat_id_str = str(self.chat_id) if self.chat_id else None
         self.ok = bool(self.token and self.chat_id)
     
     def send(self, msg):
         if not self.ok:
             return
         try:
-            requests.post(
+            HTTP.post(
                 f"https://api.telegram.org/bot{self.token}/sendMessage",
                 data={"chat_id": self.chat_id, "text": msg, "parse_mode": "HTML"},
                 timeout=30
@@ -42,25 +97,47 @@ class Telegram:
             pass
     
     def photo(self, path, caption=""):
+        """发送图片，返回 message_id（失败返回 None）"""
         if not self.ok or not os.path.exists(path):
-            return
+            return None
         try:
+            # 先整个读入内存再上传，上传期间不占用文件句柄
             with open(path, 'rb') as f:
-                requests.post(
-                    f"https://api.telegram.org/bot{self.token}/sendPhoto",
-                    data={"chat_id": self.chat_id, "caption": caption[:1024]},
-                    files={"photo": f},
-                    timeout=60
-                )
+                buf = f.read()
+            r = HTTP.post(
+                f"https://api.telegram.org/bot{self.token}/sendPhoto",
+                data={"chat_id": self.chat_id, "caption": caption[:1024]},
+                files={"photo": (os.path.basename(path), buf, 'image/jpeg')},
+                timeout=60
+            )
+            return r.json()["result"]["message_id"]
         except:
-            pass
+            return None
+    
+    def edit_photo(self, message_id, path, caption=""):
+        """替换已发送消息里的图片（editMessageMedia），避免重复发新消息"""
+        if not self.ok or not os.path.exists(path):
+            return False
+        try:
+            media = {"type": "photo", "media": "attach://photo", "caption": caption[:1024]}
+            with open(path, 'rb') as f:
+                buf = f.read()
+            r = HTTP.post(
+                f"https://api.telegram.org/bot{self.token}/editMessageMedia",
+                data={"chat_id": self.chat_id, "message_id": message_id, "media": json.dumps(media)},
+                files={"photo": (os.path.basename(path), buf, 'image/jpeg')},
+                timeout=60
+            )
+            return bool(r.json().get("ok"))
+        except:
+            return False
     
-    def flush_updates(self):
+    def flush_updates(self, http=HTTP):
         """刷新 offset 到最新，避免读到旧消息"""
         if not self.ok:
             return 0
         try:
-            r = requests.get(
+            r = http.get(
                 f"https://api.telegram.org/bot{self.token}/getUpdates",
                 params={"timeout": 0},
                 timeout=10
@@ -72,24 +149,25 @@ class Telegram:
             pass
         return 0
     
-    def wait_code(self, timeout=120):
+    def wait_code(self, timeout=120, stop=None, http=HTTP):
         """
         等待你在 TG 里发 /code 123456
-        只接受来自 TG_CHAT_ID 的消息
+        只接受来自 TG_CHAT_ID 的消息；stop 被 set 后提前结束
+        在后台线程里调用时传入独立的 http 会话
         """
         if not self.ok:
             return None
         
         # 先刷新 offset，避免读到旧的 /code
-        offset = self.flush_updates()
+        offset = self.flush_updates(http)
         deadline = time.time() + timeout
-        pattern = re.compile(r"^/code\s+(\d{6,8})$")  # 6位TOTP 或 8位恢复码也行
         
-        while time.time() < deadline:
+        while time.time() < deadline and not (stop and stop.is_set()):
             try:
-                r = requests.get(
+                # 长轮询：服务端最多挂起 25 秒，有消息立即返回，无需再额外 sleep
+                r = http.get(
                     f"https://api.telegram.org/bot{self.token}/getUpdates",
-                    params={"timeout": 20, "offset": offset},
+                    params={"timeout": 25, "offset": offset},
                     timeout=30
                 )
                 data = r.json()
@@ -101,18 +179,16 @@ class Telegram:
                     offset = upd["update_id"] + 1
                     msg = upd.get("message") or {}
                     chat = msg.get("chat") or {}
-                    if str(chat.get("id")) != str(self.chat_id):
+                    if str(chat.get("id")) != self._chat_id_str:
                         continue
                     
                     text = (msg.get("text") or "").strip()
-                    m = pattern.match(text)
+                    m = self._CODE_RE.match(text)
                     if m:
                         return m.group(1)
             
             except Exception:
-                pass
-            
-            time.sleep(2)
+                time.sleep(2)
         
         return None
 
@@ -124,6 +200,9 @@ class SecretUpdater:
         self.token = os.environ.get('REPO_TOKEN')
         self.repo = os.environ.get('GITHUB_REPOSITORY')
         self.ok = bool(self.token and self.repo)
+        self._pubkey = None  # (PublicKey, key_id)
+        self._sealed_box = None
+        self._pubkey_ts = 0
         if self.ok:
             print("✅ Secret 自动更新已启用")
         else:
@@ -140,25 +219,34 @@ class SecretUpdater:
                 "Accept": "application/vnd.github.v3+json"
             }
             
-            # 获取公钥
-            r = requests.get(
-                f"https://api.github.com/repos/{self.repo}/actions/secrets/public-key",
-                headers=headers, timeout=30
-            )
-            if r.status_code != 200:
-                return False
+            # 获取公钥（缓存，多次更新只请求一次）
+            if self._pubkey is None or time.time() - self._pubkey_ts > PUBKEY_TTL:
+                r = HTTP.get(
+                    f"https://api.github.com/repos/{self.repo}/actions/secrets/public-key",
+                    headers=headers, timeout=30
+                )
+                if r.status_code != 200:
+                    return False
+                
+                key_data = r.json()
+                pk = public.PublicKey(key_data['key'].encode(), encoding.Base64Encoder())
+                self._pubkey = (pk, key_data['key_id'])
+                self._sealed_box = public.SealedBox(pk)
+                self._pubkey_ts = time.time()
             
-            key_data = r.json()
-            pk = public.PublicKey(key_data['key'].encode(), encoding.Base64Encoder())
-            encrypted = public.SealedBox(pk).encrypt(value.encode())
+            key_id = self._pubkey[1]
+            encrypted = self._sealed_box.encrypt(value.encode())
             
             # 更新 Secret
-            r = requests.put(
+            r = HTTP.put(
                 f"https://api.github.com/repos/{self.repo}/actions/secrets/{name}",
                 headers=headers,
-                json={"encrypted_value": base64.b64encode(encrypted).decode(), "key_id": key_data['key_id']},
+                json={"encrypted_value": binascii.b2a_base64(encrypted, newline=False).decode('ascii'), "key_id": key_id},
                 timeout=30
             )
+            if 400 <= r.status_code < 500:
+                # 公钥可能已轮换，下次重新获取
+                self._pubkey = None
             return r.status_code in [201, 204]
         except Exception as e:
             print(f"更新 Secret 失败: {e}")
@@ -172,9 +260,10 @@ class AutoLogin:
         self.username = os.environ.get('GH_USERNAME')
         self.password = os.environ.get('GH_PASSWORD')
         self.gh_session = os.environ.get('GH_SESSION', '').strip()
+        self.gh_state = os.environ.get('GH_STORAGE_STATE', '').strip()
         self.tg = Telegram()
         self.secret = SecretUpdater()
-        self.shots = []
+        self._shot_intents = []  # [name, capture, file]，真正需要时才截图
         self.logs = []
         self.n = 0
         
@@ -184,27 +273,68 @@ class AutoLogin:
         print(line)
         self.logs.append(line)
     
-    def shot(self, page, name):
+    def shot(self, page, name, form=False):
+        """记录截图点（JPEG，只截视口；form=True 时只截表单区域），要发送时才真正截图"""
         self.n += 1
-        f = f"{self.n:02d}_{name}.png"
+        f = f"{self.n:02d}_{name}.jpg"
+        
+        def capture():
+            page.screenshot(path=f, type='jpeg', quality=70, full_page=False,
+                            clip=FORM_CLIP if form else None)
+            return f
+        
+        self._shot_intents.append([name, capture, None])
+    
+    def materialize_last(self, n=1):
+        """
+        返回最近 n 个截图文件
+        页面只保留当前状态，所以只补截最新的一个；更早没截过的直接跳过
+        """
+        recent = self._shot_intents[-n:]
+        if recent and recent[-1][2] is None:
+            try:
+                recent[-1][2] = recent[-1][1]()
+            except:
+                pass
+        return [i[2] for i in recent if i[2]]
+    
+    def snap(self, page, name, form=False):
+        """立即截图并返回文件（用于马上发到电报）"""
+        self.shot(page, name, form)
+        files = self.materialize_last(1)
+        return files[0] if files else None
+    
+    def find(self, page, sels, timeout=3000):
+        """
+        把多个 selector 合成一个 locator，一次等待任意一个可见（而不是逐个等 timeout）
+        每个 selector 先过滤可见元素，隐藏元素不会挡住其它候选；返回时按列表优先级选
+        """
+        locs = [page.locator(f'{s} >> visible=true') for s in sels]
+        any_loc = locs[0]
+        for loc in locs[1:]:
+            any_loc = any_loc.or_(loc)
         try:
-            page.screenshot(path=f)
-            self.shots.append(f)
+            any_loc.first.wait_for(state='visible', timeout=timeout)
         except:
-            pass
-        return f
-    
-    def click(self, page, sels, desc=""):
-        for s in sels:
+            return None
+        for loc in locs:
             try:
-                el = page.locator(s).first
-                if el.is_visible(timeout=3000):
-                    el.click()
-                    self.log(f"已点击: {desc}", "SUCCESS")
-                    return True
+                if loc.first.is_visible():
+                    return loc.first
             except:
                 pass
-        return False
+        return None
+    
+    def click(self, page, sels, desc=""):
+        el = self.find(page, sels)
+        if not el:
+            return False
+        try:
+            el.click()
+            self.log(f"已点击: {desc}", "SUCCESS")
+            return True
+        except:
+            return False
     
     def get_session(self, context):
         """提取 Session Cookie"""
@@ -235,10 +365,67 @@ class AutoLogin:
 <code>{value}</code>""")
             self.log("已通过 Telegram 发送 Cookie", "SUCCESS")
     
+    def load_state(self):
+        """加载登录状态：优先 GH_STORAGE_STATE，其次本地 gh_state.json"""
+        if self.gh_state:
+            try:
+                raw = base64.b64decode(self.gh_state)
+                json.loads(raw)
+                fd, path = tempfile.mkstemp(suffix=".json")
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(raw)
+                return path
+            except Exception as e:
+                self.log(f"GH_STORAGE_STATE 无效: {e}", "WARN")
+        if os.path.exists(STATE_FILE):
+            return STATE_FILE
+        return None
+    
+    def save_state(self, context):
+        """保存登录状态（含设备信任、CSRF 等全部 Cookie），下次运行直接复用"""
+        try:
+            context.storage_state(path=STATE_FILE)
+            with open(STATE_FILE, 'rb') as f:
+                value = base64.b64encode(f.read()).decode()
+        except Exception as e:
+            self.log(f"保存登录状态失败: {e}", "WARN")
+            return
+        
+        # GitHub Secret 上限 48KB
+        if len(value) > 48 * 1024:
+            self.log("登录状态过大，跳过更新 GH_STORAGE_STATE", "WARN")
+            return
+        if self.secret.update('GH_STORAGE_STATE', value):
+            self.log("已自动更新 GH_STORAGE_STATE", "SUCCESS")
+    
+    def progress_wait(self, page, pred, total, every, cb):
+        """
+        等待 URL 满足 pred（导航事件驱动），直接睡到下一个进度点，每 every 秒调用一次 cb(已等秒数)
+        满足返回 True，超时返回 False；cb 返回非 None 时提前结束并返回该值
+        """
+        t0 = time.time()
+        deadline = t0 + total
+        mark = t0
+        while True:
+            now = time.time()
+            if now >= deadline:
+                return False
+            while mark <= now:
+                mark += every
+            try:
+                page.wait_for_url(pred, timeout=(min(mark, deadline) - now) * 1000)
+                return True
+            except PlaywrightTimeoutError:
+                pass
+            if time.time() < deadline:
+                ret = cb(int(time.time() - t0))
+                if ret is not None:
+                    return ret
+    
     def wait_device(self, page):
         """等待设备验证"""
         self.log(f"需要设备验证，等待 {DEVICE_VERIFY_WAIT} 秒...", "WARN")
-        self.shot(page, "设备验证")
+        shot = self.snap(page, "设备验证", form=True)
         
         self.tg.send(f"""⚠️ <b>需要设备验证</b>
 
@@ -246,25 +433,21 @@ class AutoLogin:
 1️⃣ 检查邮箱点击链接
 2️⃣ 或在 GitHub App 批准""")
         
-        if self.shots:
-            self.tg.photo(self.shots[-1], "设备验证页面")
+        if shot:
+            self.tg.photo(shot, "设备验证页面")
         
-        for i in range(DEVICE_VERIFY_WAIT):
-            time.sleep(1)
-            if i % 5 == 0:
-                self.log(f"  等待... ({i}/{DEVICE_VERIFY_WAIT}秒)")
-                url = page.url
-                if 'verified-device' not in url and 'device-verification' not in url:
-                    self.log("设备验证通过！", "SUCCESS")
-                    self.tg.send("✅ <b>设备验证通过</b>")
-                    return True
-                try:
-                    page.reload(timeout=10000)
-                    page.wait_for_load_state('networkidle', timeout=10000)
-                except:
-                    pass
+        def tick(t):
+            self.log(f"  等待... ({t}/{DEVICE_VERIFY_WAIT}秒)")
+            # 设备验证页不会自己跳转（邮件链接是在别处批准的），每 5 秒刷新一次才能发现已批准
+            try:
+                page.reload(timeout=10000, wait_until='domcontentloaded')
+            except:
+                pass
         
-        if 'verified-device' not in page.url:
+        # 不再每秒轮询，等待页面离开设备验证流程（导航事件驱动）
+        if self.progress_wait(page, lambda u: not _DEVICE_RE.search(u), DEVICE_VERIFY_WAIT, 5, tick):
+            self.log("设备验证通过！", "SUCCESS")
+            self.tg.send("✅ <b>设备验证通过</b>")
             return True
         
         self.log("设备验证超时", "ERROR")
@@ -276,45 +459,71 @@ class AutoLogin:
         self.log(f"需要两步验证（GitHub Mobile），等待 {TWO_FACTOR_WAIT} 秒...", "WARN")
         
         # 先截图并立刻发出去（让你看到数字）
-        shot = self.shot(page, "两步验证_mobile")
+        shot = self.snap(page, "两步验证_mobile", form=True)
         self.tg.send(f"""⚠️ <b>需要两步验证（GitHub Mobile）</b>
 
 请打开手机 GitHub App 批准本次登录（会让你确认一个数字）。
+也可以在 Telegram 里发送 <code>/code 你的6位验证码</code> 改用验证码登录。
 等待时间：{TWO_FACTOR_WAIT} 秒""")
-        if shot:
-            self.tg.photo(shot, "两步验证页面（数字在图里）")
+        mid = self.tg.photo(shot, "两步验证页面（数字在图里）") if shot else None
+        
+        # 同时等待手机批准和 TG 验证码，谁先到用谁
+        codes = {}
+        stop = threading.Event()
+        
+        def poll():
+            # 独立会话，不和主线程的 send/photo 共用 HTTP
+            with new_session() as http:
+                codes['code'] = self.tg.wait_code(TWO_FACTOR_WAIT, stop, http)
+        
+        if self.tg.ok:
+            threading.Thread(target=poll, daemon=True).start()
+        
+        next_report = 10
+        
+        def tick(t):
+            nonlocal mid, next_report
+            if codes.get('code'):
+                # submit_code 会提示"收到验证码"
+                self.switch_to_code(page)
+                return ('code', self.submit_code(page, codes['code']))
+            if t < next_report:
+                return None
+            next_report += 10
+            # 每 10 秒打印一次，并更新同一条消息里的截图（防止你没看到数字）
+            self.log(f"  等待... ({t}/{TWO_FACTOR_WAIT}秒)")
+            shot = self.snap(page, f"两步验证_{t}s", form=True)
+            if shot:
+                caption = f"两步验证页面（第{t}秒）"
+                if not (mid and self.tg.edit_photo(mid, shot, caption)):
+                    mid = self.tg.photo(shot, caption)
+            return None
         
-        # 不要频繁 reload，避免把流程刷回登录页
-        for i in range(TWO_FACTOR_WAIT):
-            time.sleep(1)
-            
-            url = page.url
-            
-            # 如果离开 two-factor 流程页面，认为通过
-            if "github.com/sessions/two-factor/" not in url:
-                self.log("两步验证通过！", "SUCCESS")
-                self.tg.send("✅ <b>两步验证通过</b>")
-                return True
-            
+        try:
+            # 不要 reload，避免把流程刷回登录页；等待导航事件离开 two-factor 页面
+            # 每 2 秒看一眼 TG 验证码：TOTP 只有约 30 秒有效，收到后要尽快填入
+            ret = self.progress_wait(page, lambda u: not _TWO_FACTOR_RE.search(u), TWO_FACTOR_WAIT, 2, tick)
+        finally:
+            stop.set()
+        
+        if ret is False and codes.get('code'):
+            # 验证码在最后一个间隔里才到，progress_wait 已超时不再回调
+            self.switch_to_code(page)
+            return self.submit_code(page, codes['code'])
+        
+        if isinstance(ret, tuple):
+            # 走了验证码分支，结果已由 submit_code 给出
+            return ret[1]
+        
+        if ret:
             # 如果被刷回登录页，说明这次流程断了（不要硬等）
-            if "github.com/login" in url:
+            if _LOGIN_RE.search(page.url):
                 self.log("两步验证后回到了登录页，需重新登录", "ERROR")
                 return False
             
-            # 每 10 秒打印一次，并补发一次截图（防止你没看到数字）
-            if i % 10 == 0 and i != 0:
-                self.log(f"  等待... ({i}/{TWO_FACTOR_WAIT}秒)")
-                shot = self.shot(page, f"两步验证_{i}s")
-                if shot:
-                    self.tg.photo(shot, f"两步验证页面（第{i}秒）")
-            
-            # 只在 30 秒、60 秒... 做一次轻刷新（可选，频率很低）
-            if i % 30 == 0 and i != 0:
-                try:
-                    page.reload(timeout=30000)
-                    page.wait_for_load_state('domcontentloaded', timeout=30000)
-                except:
-                    pass
+            self.log("两步验证通过！", "SUCCESS")
+            self.tg.send("✅ <b>两步验证通过</b>")
+            return True
         
         self.log("两步验证超时", "ERROR")
         self.tg.send("❌ <b>两步验证超时</b>")
@@ -323,30 +532,8 @@ class AutoLogin:
     def handle_2fa_code_input(self, page):
         """处理 TOTP 验证码输入（通过 Telegram 发送 /code 123456）"""
         self.log("需要输入验证码", "WARN")
-        shot = self.shot(page, "两步验证_code")
-        
-        # 先尝试点击"Use an authentication app"或类似按钮（如果在 mobile 页面）
-        try:
-            more_options = [
-                'a:has-text("Use an authentication app")',
-                'a:has-text("Enter a code")',
-                'button:has-text("Use an authentication app")',
-                '[href*="two-factor/app"]'
-            ]
-            for sel in more_options:
-                try:
-                    el = page.locator(sel).first
-                    if el.is_visible(timeout=2000):
-                        el.click()
-                        time.sleep(2)
-                        page.wait_for_load_state('networkidle', timeout=15000)
-                        self.log("已切换到验证码输入页面", "SUCCESS")
-                        shot = self.shot(page, "两步验证_code_切换后")
-                        break
-                except:
-                    pass
-        except:
-            pass
+        self.shot(page, "两步验证_code", form=True)
+        self.switch_to_code(page)
         
         # 发送提示并等待验证码
         self.tg.send(f"""🔐 <b>需要验证码登录</b>
@@ -355,8 +542,8 @@ class AutoLogin:
 <code>/code 你的6位验证码</code>
 
 等待时间：{TWO_FACTOR_WAIT} 秒""")
-        if shot:
-            self.tg.photo(shot, "两步验证页面")
+        for f in self.materialize_last(1):
+            self.tg.photo(f, "两步验证页面")
         
         self.log(f"等待验证码（{TWO_FACTOR_WAIT}秒）...", "WARN")
         code = self.tg.wait_code(timeout=TWO_FACTOR_WAIT)
@@ -366,6 +553,28 @@ class AutoLogin:
             self.tg.send("❌ <b>等待验证码超时</b>")
             return False
         
+        return self.submit_code(page, code)
+    
+    def switch_to_code(self, page):
+        """尝试点击"Use an authentication app"或类似按钮（如果在 mobile 页面），切到验证码输入"""
+        more_options = [
+            'a:has-text("Use an authentication app")',
+            'a:has-text("Enter a code")',
+            'button:has-text("Use an authentication app")',
+            '[href*="two-factor/app"]'
+        ]
+        try:
+            el = self.find(page, more_options, timeout=2000)
+            if el:
+                el.click()
+                page.wait_for_load_state('domcontentloaded', timeout=15000)
+                self.log("已切换到验证码输入页面", "SUCCESS")
+                self.shot(page, "两步验证_code_切换后", form=True)
+        except:
+            pass
+    
+    def submit_code(self, page, code):
+        """填入验证码并提交"""
         # 不打印验证码明文，只提示收到
         self.log("收到验证码，正在填入...", "SUCCESS")
         self.tg.send("✅ 收到验证码，正在填入...")
@@ -380,49 +589,43 @@ class AutoLogin:
             'input[inputmode="numeric"]'
         ]
         
-        for sel in selectors:
+        el = self.find(page, selectors, timeout=2000)
+        if el:
             try:
-                el = page.locator(sel).first
-                if el.is_visible(timeout=2000):
-                    el.fill(code)
-                    self.log(f"已填入验证码", "SUCCESS")
-                    time.sleep(1)
-                    
-                    # 优先点击 Verify 按钮，不行再 Enter
-                    submitted = False
-                    verify_btns = [
-                        'button:has-text("Verify")',
-                        'button[type="submit"]',
-                        'input[type="submit"]'
-                    ]
-                    for btn_sel in verify_btns:
-                        try:
-                            btn = page.locator(btn_sel).first
-                            if btn.is_visible(timeout=1000):
-                                btn.click()
-                                submitted = True
-                                self.log("已点击 Verify 按钮", "SUCCESS")
-                                break
-                        except:
-                            pass
-                    
-                    if not submitted:
-                        page.keyboard.press("Enter")
-                        self.log("已按 Enter 提交", "SUCCESS")
-                    
-                    time.sleep(3)
-                    page.wait_for_load_state('networkidle', timeout=30000)
-                    self.shot(page, "验证码提交后")
-                    
-                    # 检查是否通过
-                    if "github.com/sessions/two-factor/" not in page.url:
-                        self.log("验证码验证通过！", "SUCCESS")
-                        self.tg.send("✅ <b>验证码验证通过</b>")
-                        return True
-                    else:
-                        self.log("验证码可能错误", "ERROR")
-                        self.tg.send("❌ <b>验证码可能错误，请检查后重试</b>")
-                        return False
+                el.fill(code)
+                self.log(f"已填入验证码", "SUCCESS")
+                time.sleep(1)
+                
+                # 优先点击 Verify 按钮，不行再 Enter
+                verify_btns = [
+                    'button:has-text("Verify")',
+                    'button[type="submit"]',
+                    'input[type="submit"]'
+                ]
+                btn = self.find(page, verify_btns, timeout=1000)
+                if btn:
+                    btn.click()
+                    self.log("已点击 Verify 按钮", "SUCCESS")
+                else:
+                    page.keyboard.press("Enter")
+                    self.log("已按 Enter 提交", "SUCCESS")
+                
+                # 等待离开 two-factor 页面；超时说明验证码没通过
+                try:
+                    page.wait_for_url(lambda u: not _TWO_FACTOR_RE.search(u), timeout=15000)
+                except PlaywrightTimeoutError:
+                    pass
+                self.shot(page, "验证码提交后")
+                
+                # 检查是否通过
+                if not _TWO_FACTOR_RE.search(page.url):
+                    self.log("验证码验证通过！", "SUCCESS")
+                    self.tg.send("✅ <b>验证码验证通过</b>")
+                    return True
+                else:
+                    self.log("验证码可能错误", "ERROR")
+                    self.tg.send("❌ <b>验证码可能错误，请检查后重试</b>")
+                    return False
             except:
                 pass
         
@@ -433,51 +636,74 @@ class AutoLogin:
     def login_github(self, page, context):
         """登录 GitHub"""
         self.log("登录 GitHub...", "STEP")
-        self.shot(page, "github_登录页")
+        self.shot(page, "github_登录页", form=True)
         
+        before = page.url
         try:
-            page.locator('input[name="login"]').fill(self.username)
-            page.locator('input[name="password"]').fill(self.password)
-            self.log("已输入凭据")
+            # 一次 evaluate 完成填写 + 提交
+            page.evaluate("""([u, p]) => {
+                const login = document.querySelector('input[name="login"]');
+                const password = document.querySelector('input[name="password"]');
+                if (!login || !password || !login.form) throw new Error('找不到登录表单');
+                login.value = u;
+                password.value = p;
+                // 带上提交按钮，和点击按钮时提交的字段（commit=Sign in）一致
+                const submitter = login.form.querySelector('[type=submit]') || undefined;
+                login.form.requestSubmit ? login.form.requestSubmit(submitter) : login.form.submit();
+            }""", [self.username, self.password])
+            self.log("已输入凭据并提交")
         except Exception as e:
-            self.log(f"输入失败: {e}", "ERROR")
-            return False
+            # 提交引发的导航可能先于 evaluate 返回，这种情况已经提交成功
+            submitted = page.url != before or 'context was destroyed' in str(e)
+        else:
+            submitted = True
         
-        self.shot(page, "github_已填写")
+        if not submitted:
+            # 表单结构变了，退回逐个填写 + 点击
+            try:
+                page.locator('input[name="login"]').fill(self.username)
+                page.locator('input[name="password"]').fill(self.password)
+                self.log("已输入凭据")
+            except Exception as e:
+                self.log(f"输入失败: {e}", "ERROR")
+                return False
+            
+            self.shot(page, "github_已填写", form=True)
+            
+            try:
+                page.locator('input[type="submit"], button[type="submit"]').first.click()
+            except:
+                pass
         
+        # 提交后 URL 一定会变（设备验证 / 2FA / 授权页 / 错误页），等到变了再继续
         try:
-            page.locator('input[type="submit"], button[type="submit"]').first.click()
-        except:
+            page.wait_for_url(lambda u: u != before, timeout=30000)
+        except PlaywrightTimeoutError:
             pass
-        
-        time.sleep(3)
-        page.wait_for_load_state('networkidle', timeout=30000)
-        self.shot(page, "github_登录后")
+        self.shot(page, "github_登录后", form=True)
         
         url = page.url
         self.log(f"当前: {url}")
         
         # 设备验证
-        if 'verified-device' in url or 'device-verification' in url:
+        if _DEVICE_RE.search(url):
             if not self.wait_device(page):
                 return False
-            time.sleep(2)
-            page.wait_for_load_state('networkidle', timeout=30000)
+            page.wait_for_load_state('domcontentloaded', timeout=30000)
             self.shot(page, "验证后")
         
         # 2FA
-        if 'two-factor' in page.url:
+        if _TWO_FACTOR_RE.search(page.url):
             self.log("需要两步验证！", "WARN")
-            self.shot(page, "两步验证")
+            self.shot(page, "两步验证", form=True)
             
             # GitHub Mobile：等待你在手机上批准
-            if 'two-factor/mobile' in page.url:
+            if _TWO_FACTOR_MOBILE_RE.search(page.url):
                 if not self.wait_two_factor_mobile(page):
                     return False
                 # 通过后等页面稳定
                 try:
-                    page.wait_for_load_state('networkidle', timeout=30000)
-                    time.sleep(2)
+                    page.wait_for_load_state('domcontentloaded', timeout=30000)
                 except:
                     pass
             
@@ -487,8 +713,7 @@ class AutoLogin:
                     return False
                 # 通过后等页面稳定
                 try:
-                    page.wait_for_load_state('networkidle', timeout=30000)
-                    time.sleep(2)
+                    page.wait_for_load_state('domcontentloaded', timeout=30000)
                 except:
                     pass
         
@@ -505,40 +730,57 @@ class AutoLogin:
     
     def oauth(self, page):
         """处理 OAuth"""
-        if 'github.com/login/oauth/authorize' in page.url:
+        if _OAUTH_RE.search(page.url):
             self.log("处理 OAuth...", "STEP")
             self.shot(page, "oauth")
             self.click(page, ['button[name="authorize"]', 'button:has-text("Authorize")'], "授权")
-            time.sleep(3)
-            page.wait_for_load_state('networkidle', timeout=30000)
+            try:
+                page.wait_for_url(lambda u: not _OAUTH_RE.search(u), timeout=30000)
+            except PlaywrightTimeoutError:
+                pass
     
     def wait_redirect(self, page, wait=60):
         """等待重定向"""
         self.log("等待重定向...", "STEP")
-        for i in range(wait):
-            url = page.url
-            if 'claw.cloud' in url and 'signin' not in url.lower():
+        deadline = time.time() + wait
+        while True:
+            left = deadline - time.time()
+            # 等待导航事件：到达 ClawCloud 或停在 OAuth 授权页
+            if left <= 0 or not self.progress_wait(
+                page, lambda u: bool(_FINAL_RE.match(u) or _OAUTH_RE.search(u)), left, 10,
+                lambda t: self.log(f"  等待... ({wait - int(left) + t}秒)")
+            ):
+                break
+            if _FINAL_RE.match(page.url):
                 self.log("重定向成功！", "SUCCESS")
                 return True
-            if 'github.com/login/oauth/authorize' in url:
-                self.oauth(page)
-            time.sleep(1)
-            if i % 10 == 0:
-                self.log(f"  等待... ({i}秒)")
+            self.oauth(page)
         self.log("重定向超时", "ERROR")
         return False
     
     def keepalive(self, page):
         """保活"""
         self.log("保活...", "STEP")
-        for url, name in [(f"{CLAW_CLOUD_URL}/", "控制台"), (f"{CLAW_CLOUD_URL}/apps", "应用")]:
+        # 两个页面并行加载：goto 只等到响应提交（commit），加载过程在浏览器里重叠进行
+        apps = page.context.new_page()
+        visits = [(page, f"{CLAW_CLOUD_URL}/", "控制台"), (apps, f"{CLAW_CLOUD_URL}/apps", "应用")]
+        started = []
+        for p, url, name in visits:
+            try:
+                p.goto(url, timeout=30000, wait_until='commit')
+                started.append((p, name))
+            except:
+                pass
+        for p, name in started:
             try:
-                page.goto(url, timeout=30000)
-                page.wait_for_load_state('networkidle', timeout=15000)
+                p.wait_for_load_state('domcontentloaded', timeout=15000)
                 self.log(f"已访问: {name}", "SUCCESS")
-                time.sleep(2)
             except:
                 pass
+        try:
+            apps.close()
+        except:
+            pass
         self.shot(page, "完成")
     
     def notify(self, ok, err=""):
@@ -558,12 +800,12 @@ class AutoLogin:
         
         self.tg.send(msg)
         
-        if self.shots:
-            if not ok:
-                for s in self.shots[-3:]:
-                    self.tg.photo(s, s)
-            else:
-                self.tg.photo(self.shots[-1], "完成")
+        if not ok:
+            for s in self.materialize_last(3):
+                self.tg.photo(s, s)
+        else:
+            for s in self.materialize_last(1):
+                self.tg.photo(s, "完成")
     
     def run(self):
         print("\n" + "="*50)
@@ -572,6 +814,7 @@ class AutoLogin:
         
         self.log(f"用户名: {self.username}")
         self.log(f"Session: {'有' if self.gh_session else '无'}")
+        self.log(f"登录状态: {'有' if self.gh_state or os.path.exists(STATE_FILE) else '无'}")
         self.log(f"密码: {'有' if self.password else '无'}")
         
         if not self.username or not self.password:
@@ -581,15 +824,32 @@ class AutoLogin:
         
         with sync_playwright() as p:
             browser = p.chromium.launch(headless=True, args=['--no-sandbox'])
-            context = browser.new_context(
-                viewport={'width': 1920, 'height': 1080},
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            )
+            state = self.load_state()
+            context_args = {
+                'viewport': {'width': 1280, 'height': 800},
+                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            }
+            try:
+                context = browser.new_context(storage_state=state, **context_args)
+            except Exception as e:
+                # 格式不对的登录状态，退回到 GH_SESSION 注入
+                self.log(f"登录状态加载失败: {e}", "WARN")
+                context = browser.new_context(**context_args)
+                loaded = False
+            else:
+                loaded = bool(state)
+            finally:
+                # 临时文件里是全部 GitHub Cookie，用完立即删除
+                if state and state != STATE_FILE:
+                    os.unlink(state)
+            context.route(BLOCK_RE, block_assets)
             page = context.new_page()
             
             try:
-                # 预加载 Cookie
-                if self.gh_session:
+                # 预加载 Cookie（没有完整登录状态时才退回到只注入 user_session）
+                if loaded:
+                    self.log("已加载登录状态", "SUCCESS")
+                elif self.gh_session:
                     try:
                         context.add_cookies([
                             {'name': 'user_session', 'value': self.gh_session, 'domain': 'github.com', 'path': '/'},
@@ -602,13 +862,18 @@ class AutoLogin:
                 # 1. 访问 ClawCloud
                 self.log("步骤1: 打开 ClawCloud", "STEP")
                 page.goto(SIGNIN_URL, timeout=60000)
-                page.wait_for_load_state('networkidle', timeout=30000)
-                time.sleep(2)
+                page.wait_for_load_state('domcontentloaded', timeout=30000)
+                # 已有会话时前端会自己跳走；留在 Playwright 调用里等，路由回调才能继续处理请求
+                try:
+                    page.wait_for_url(lambda u: bool(_FINAL_RE.match(u)), timeout=2000)
+                except PlaywrightTimeoutError:
+                    pass
                 self.shot(page, "clawcloud")
                 
-                if 'signin' not in page.url.lower():
+                if _FINAL_RE.match(page.url):
                     self.log("已登录！", "SUCCESS")
                     self.keepalive(page)
+                    self.save_state(context)
                     # 提取并保存新 Cookie
                     new = self.get_session(context)
                     if new:
@@ -628,8 +893,23 @@ class AutoLogin:
                     self.notify(False, "找不到 GitHub 按钮")
                     sys.exit(1)
                 
-                time.sleep(3)
-                page.wait_for_load_state('networkidle', timeout=30000)
+                # 先等离开登录页：跳到 GitHub，或已授权直接回到 ClawCloud
+                try:
+                    page.wait_for_url(
+                        lambda u: 'github.com' in u or bool(_FINAL_RE.match(u)),
+                        timeout=15000, wait_until='commit'
+                    )
+                except PlaywrightTimeoutError:
+                    pass
+                # 在 GitHub 上时只等后续步骤需要的元素出现（登录表单或授权按钮），不等网络空闲
+                if 'github.com' in page.url:
+                    try:
+                        page.wait_for_selector(
+                            'input[name="login"], input[name="password"], button[name="authorize"]',
+                            timeout=15000
+                        )
+                    except:
+                        pass
                 self.shot(page, "点击后")
                 
                 url = page.url
@@ -638,14 +918,14 @@ class AutoLogin:
                 # 3. GitHub 登录
                 self.log("步骤3: GitHub 认证", "STEP")
                 
-                if 'github.com/login' in url or 'github.com/session' in url:
+                if _OAUTH_RE.search(url):
+                    self.log("Cookie 有效", "SUCCESS")
+                    self.oauth(page)
+                elif _GH_AUTH_RE.search(url):
                     if not self.login_github(page, context):
                         self.shot(page, "登录失败")
                         self.notify(False, "GitHub 登录失败")
                         sys.exit(1)
-                elif 'github.com/login/oauth/authorize' in url:
-                    self.log("Cookie 有效", "SUCCESS")
-                    self.oauth(page)
                 
                 # 4. 等待重定向
                 self.log("步骤4: 等待重定向", "STEP")
@@ -658,12 +938,13 @@ class AutoLogin:
                 
                 # 5. 验证
                 self.log("步骤5: 验证", "STEP")
-                if 'claw.cloud' not in page.url or 'signin' in page.url.lower():
+                if not _FINAL_RE.match(page.url):
                     self.notify(False, "验证失败")
                     sys.exit(1)
                 
                 # 6. 保活
                 self.keepalive(page)
+                self.save_state(context)
                 
                 # 7. 提取并保存新 Cookie
                 self.log("步骤6: 更新 Cookie", "STEP")
@@ -687,6 +968,7 @@ class AutoLogin:
                 sys.exit(1)
             finally:
                 browser.close()
+                HTTP.close()
 
 
 if __name__ == "__main__":